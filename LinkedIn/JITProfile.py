@@ -20,17 +20,39 @@
 
 import oauth2
 import cjson
+import json
 import re
+import os
+import sys
+import time
+import random
+import bisect
+import hashlib
+import zlib
 import textwrap
+import threading
+import Queue
 
-from os.path import expanduser
+from multiprocessing.pool import ThreadPool
+
+from os.path import expanduser, exists, join
+from collections import OrderedDict
 from enchant.checker import SpellChecker
 
+from odf.element import Element
+from odf.namespaces import nsdict
 from odf.opendocument import OpenDocumentText
 from odf.style import Style, TextProperties, ParagraphProperties, TableColumnProperties
 from odf.table import Table, TableColumn, TableRow, TableCell
 from odf.text import A, P, Span
 
+# odfpy keeps the namespaces it has seen in one dict shared by every
+# document and declares all of them at the top of each document it
+# writes, so a document's xml depends on what was built before it, and
+# the dict can change while another thread is writing it out. filling
+# it with every namespace odfpy knows, once, makes it fixed from here on.
+Element.namespaces.update(nsdict)
+
 def max(a,b) :
     if a > b :
         return a
@@ -56,6 +78,10 @@ class Config :
         self.data['skills_max'] = 1000
         self.data['experience_max'] = 1000
         self.data['certificates_max'] = 1000
+        self.data['snapshot_dir'] = expanduser('~') + '/.jitsnapshots'
+        self.data['profile_name'] = 'default'
+        self.data['checkers_max'] = 4
+        self.data['api_url'] = 'http://api.linkedin.com'
         self.data['fields'] = 'first-name,last-name,industry,main-address,' +\
             'email-address,member-url-resources,phone-numbers,' +\
             'headline,location,num-recommenders,current-status,' +\
@@ -106,14 +132,364 @@ class LinkedIn(App) :
         token = oauth2.Token(key=self.config.fetch('user_token'),
                              secret=self.config.fetch('user_secret'))
         client = oauth2.Client(ouser, token)
-        req = 'http://api.linkedin.com/v1/people/~:(' +\
+        req = self.config.fetch('api_url') + '/v1/people/~:(' +\
               self.config.fetch('fields') + \
               ')?format=json&secure-urls=true'
         response, result = client.request(req, 'GET', '')
+        # don't hand back (and cache) an error or throttle message
+        # as if it were the profile
+        if response['status'] != '200' :
+            raise Error(int(response['status']), result)
         return result
 
+# keeps every fetched version of a profile instead of overwriting the
+# one cached copy. most refreshes only change a field or two so each
+# piece of a profile is stored once under the sha1 of its (canonical)
+# json text. the plain fields all go in one object, and the collections
+# (positions, skills, etc) are split per item so that adding a job
+# doesn't copy all the old ones. a version is a manifest object naming
+# those pieces, and the versions of every profile are listed in one
+# index, one short line per version:
+#
+#   <snapshot_dir>/objects.pack    compressed objects end to end
+#   <snapshot_dir>/objects.idx     hash offset length
+#   <snapshot_dir>/versions.idx    name timestamp size manifest-hash
+#
+# everything is packed into a few files rather than a file each since
+# most objects (and most profiles' histories) are far smaller than a
+# disk block.
+class ProfileStore(App) :
+    # stores in the same process share the pack file. only one process
+    # should be writing to a snapshot directory at a time.
+    lock = threading.Lock()
+    # collection items smaller than this (skills, languages) are kept
+    # in the collection itself. on their own they would cost more in
+    # index lines and references than deduplicating them saves.
+    chunkMin = 256
+    # how many objects' json text to keep in memory per store
+    cacheMax = 1000
+
+    def __init__(self, directory=None) :
+        App.__init__(self)
+        if directory is None :
+            directory = self.config.fetch('snapshot_dir')
+        self.directory = directory
+        self.packPath = join(directory, 'objects.pack')
+        self.packIndexPath = join(directory, 'objects.idx')
+        self.versionsPath = join(directory, 'versions.idx')
+        self.offsets = {}
+        self.seen = 0
+        self.texts = OrderedDict()
+        self.indexes = {}
+        self.versionsSeen = 0
+        if not exists(directory) :
+            os.makedirs(directory)
+
+    # json (not cjson) is used for encoding since the hashes are only
+    # stable if the keys always come out in the same order
+    def encode(self, value) :
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+    # calls parse on each line appended to an index file since offset
+    # and returns the new offset. a trailing partial line (still being
+    # written) is left for next time.
+    def readIndex(self, path, offset, parse) :
+        try :
+            f = open(path, 'r')
+        except IOError :
+            return offset
+        f.seek(offset)
+        for line in f :
+            if not line.endswith('\n') :
+                break
+            parse(line[:-1])
+            offset += len(line)
+        f.close()
+        return offset
+
+    # picks up any objects added (possibly by another store) since the
+    # pack index was last read
+    def refresh(self) :
+        def parse(line) :
+            key, offset, length = line.split()
+            self.offsets[key] = (int(offset), int(length))
+        self.seen = self.readIndex(self.packIndexPath, self.seen, parse)
+
+    # write a value once, keyed by its hash. the object goes into the
+    # pack before its index line so a reader never finds half of one.
+    def put(self, value) :
+        text = self.encode(value)
+        key = hashlib.sha1(text).hexdigest()
+        with ProfileStore.lock :
+            self.refresh()
+            if not self.offsets.has_key(key) :
+                data = zlib.compress(text)
+                f = open(self.packPath, 'ab')
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(data)
+                f.close()
+                f = open(self.packIndexPath, 'a')
+                f.write('%s %d %d\n' % (key, offset, len(data)))
+                f.close()
+                self.refresh()
+        return key
+
+    # objects never change once written so the most recently read ones
+    # are cached. it is the json text that is kept, and it is decoded
+    # on every get, so callers can't change what later calls return.
+    def get(self, key) :
+        with ProfileStore.lock :
+            text = self.texts.pop(key, None)
+        if text is None :
+            if not self.offsets.has_key(key) :
+                with ProfileStore.lock :
+                    self.refresh()
+            offset, length = self.offsets[key]
+            f = open(self.packPath, 'rb')
+            f.seek(offset)
+            text = zlib.decompress(f.read(length))
+            f.close()
+        with ProfileStore.lock :
+            self.texts[key] = text
+            while len(self.texts) > self.cacheMax :
+                self.texts.popitem(last=False)
+        return cjson.decode(text)
+
+    # linkedin returns collections as {'_total': n, 'values': [...]},
+    # leaving out the values when there are none
+    def isCollection(self, value) :
+        return isinstance(value, dict) and \
+               (value.has_key('_total') or
+                isinstance(value.get('values'), list))
+
+    # picks up any versions saved (possibly by another store) since
+    # the versions index was last read
+    def refreshVersions(self) :
+        def parse(line) :
+            name, stamp, size, manifest = line.split('\t')
+            index = self.indexes.setdefault(name, [])
+            bisect.insort(index, (float(stamp), manifest, int(size)))
+        self.versionsSeen = self.readIndex(self.versionsPath,
+                                           self.versionsSeen, parse)
+
+    # returns the list of (timestamp, manifest hash, size) for a
+    # profile sorted by time, oldest first
+    def versions(self, name=None) :
+        if name is None :
+            name = self.config.fetch('profile_name')
+        self.refreshVersions()
+        return self.indexes.get(name, [])
+
+    # records a new version of the profile (either the raw json text
+    # from linkedin or the decoded data) and returns its timestamp.
+    # nothing is written if the profile hasn't changed.
+    def save(self, profile, name=None, stamp=None) :
+        if name is None :
+            name = self.config.fetch('profile_name')
+        if isinstance(profile, basestring) :
+            profile = cjson.decode(profile)
+        if stamp is None :
+            stamp = time.time()
+        fields = {}
+        collections = {}
+        for section, value in profile.items() :
+            if self.isCollection(value) :
+                tree = dict(value)
+                if tree.has_key('values') :
+                    tree['values'] = [self.chunk(v) for v in value['values']]
+                collections[section] = self.put(tree)
+            else :
+                fields[section] = value
+        manifest = self.put({'fields': self.put(fields),
+                             'collections': collections})
+        with ProfileStore.lock :
+            # another store may have added versions since we last looked
+            self.refreshVersions()
+            # unchanged means the same as the version just before this
+            # one, which isn't the newest if stamp is in the past
+            index = self.indexes.get(name, [])
+            i = bisect.bisect_right([v[0] for v in index], stamp)
+            if i and index[i - 1][1] == manifest :
+                return index[i - 1][0]
+            size = len(self.encode(profile))
+            f = open(self.versionsPath, 'a')
+            f.write('%s\t%f\t%d\t%s\n' % (name, stamp, size, manifest))
+            f.close()
+            self.refreshVersions()
+        return stamp
+
+    # a collection item is stored as the hash of its own object, or
+    # inline in a one element list when it is too small to be worth it
+    def chunk(self, value) :
+        if len(self.encode(value)) < self.chunkMin :
+            return [value]
+        return self.put(value)
+
+    def unchunk(self, entry) :
+        if isinstance(entry, list) :
+            return entry[0]
+        return self.get(entry)
+
+    # rebuilds the collections named by a manifest, all of them unless
+    # only is given
+    def loadCollections(self, manifest, only=None) :
+        data = {}
+        for section, key in self.get(manifest)['collections'].items() :
+            if only is None or section in only :
+                tree = self.get(key)
+                if tree.has_key('values') :
+                    tree['values'] = [self.unchunk(v)
+                                      for v in tree['values']]
+                data[section] = tree
+        return data
+
+    def load(self, manifest) :
+        data = dict(self.get(self.get(manifest)['fields']))
+        data.update(self.loadCollections(manifest))
+        return data
+
+    # the number of versions in stamps saved no later than when, which
+    # may be given as seconds since the epoch or as 'YYYY-MM-DD' in
+    # which case the whole (local) day is included
+    def position(self, stamps, when) :
+        if isinstance(when, basestring) :
+            day = time.strptime(when, '%Y-%m-%d')
+            # mktime works out the day after (even at the end of a
+            # month) and whether it starts in daylight saving time
+            midnight = time.mktime((day.tm_year, day.tm_mon,
+                                    day.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+            return bisect.bisect_left(stamps, midnight)
+        return bisect.bisect_right(stamps, float(when))
+
+    # find the version that was current at the given time. with no
+    # time the latest version is returned.
+    def find(self, when=None, name=None) :
+        index = self.versions(name)
+        if not index :
+            raise Error('no snapshots for profile')
+        if when is None :
+            return index[-1]
+        stamps = [v[0] for v in index]
+        i = self.position(stamps, when)
+        if i == 0 :
+            raise Error('no snapshot as of ' + str(when))
+        return index[i - 1]
+
+    # returns the profile data as of a date in the same form as the
+    # linkedin response so it can be passed straight to a Resume
+    def asOf(self, when=None, name=None) :
+        return self.load(self.find(when, name)[1])
+
+    # compares two versions section by section. only hashes are
+    # compared so collections that didn't change are never read. the
+    # result maps each changed section to an (old, new) pair, with
+    # None standing in for a section that was added or removed.
+    def diff(self, a, b=None, name=None) :
+        old = self.find(a, name)[1]
+        new = self.find(b, name)[1]
+        result = {}
+        if old == new :
+            return result
+        x = self.get(old)
+        y = self.get(new)
+        oldData = self.get(x['fields'])
+        newData = self.get(y['fields'])
+        changed = set(section for section in
+                      set(oldData.keys()) | set(newData.keys())
+                      if oldData.get(section) != newData.get(section))
+        changed |= set(section for section in
+                       set(x['collections'].keys()) |
+                       set(y['collections'].keys())
+                       if x['collections'].get(section) !=
+                          y['collections'].get(section))
+        # a section may be a plain field in one version and a
+        # collection in the other, so both halves are looked up in both
+        oldData.update(self.loadCollections(old, changed))
+        newData.update(self.loadCollections(new, changed))
+        for section in changed :
+            result[section] = (oldData.get(section), newData.get(section))
+        return result
+
+    # reports how much space the deduplication saves: the size all the
+    # versions would take as full copies, the bytes actually stored,
+    # the disk space those files really take up (whole blocks), and
+    # the ratio of full copies to disk space
+    def savings(self) :
+        self.refreshVersions()
+        logical = 0
+        for index in self.indexes.values() :
+            for stamp, manifest, size in index :
+                logical += size
+        stored = 0
+        disk = 0
+        for path, dirs, files in os.walk(self.directory) :
+            for name in files :
+                st = os.stat(join(path, name))
+                stored += st.st_size
+                disk += st.st_blocks * 512
+        ratio = 0.0
+        if disk :
+            ratio = float(logical) / disk
+        return (logical, stored, disk, ratio)
+
+# enchant spell checkers hold the text being checked so one can't be
+# shared between threads, and they are too expensive to create for
+# every paragraph. the pool hands out at most size checkers, creating
+# them as needed, and blocks when they are all in use.
+class CheckerPool :
+    def __init__(self, language, size) :
+        self.language = language
+        self.size = size
+        self.count = 0
+        self.lock = threading.Lock()
+        self.free = Queue.Queue()
+
+    # if a checker can't be created (no dictionary, say) its slot is
+    # given back and a None is queued to wake a waiting thread, which
+    # then tries for itself, so every caller sees the error rather
+    # than waiting forever for a checker that will never come
+    def acquire(self) :
+        while True :
+            try :
+                chkr = self.free.get_nowait()
+            except Queue.Empty :
+                with self.lock :
+                    create = self.count < self.size
+                    if create :
+                        self.count += 1
+                if create :
+                    try :
+                        return SpellChecker(self.language)
+                    except :
+                        with self.lock :
+                            self.count -= 1
+                        self.free.put(None)
+                        raise
+                chkr = self.free.get()
+            if chkr is not None :
+                return chkr
+
+    def release(self, chkr) :
+        self.free.put(chkr)
+
+    # returns the misspelled words in text
+    def check(self, text) :
+        chkr = self.acquire()
+        try :
+            chkr.set_text(text)
+            return [err.word for err in chkr]
+        finally :
+            self.release(chkr)
+
 class Resume(App) :
-    def __init__(self) :
+    # shared by every resume in the process (see checkerPool)
+    checkers = None
+    checkersLock = threading.Lock()
+    # only one thread at a time should fetch a missing ~/.jitresume
+    cacheLock = threading.Lock()
+
+    def __init__(self, data=None) :
         App.__init__(self)
         self.width = int(self.config.fetch('page_width'))
         # regarding adding words to the spell checker, I didn't
@@ -121,23 +497,63 @@ class Resume(App) :
         # so I simply added a list of words to .config/enchant/en_US.dic
         # (local dictionary) I think that is what some other UI would
         # do anyway and now these words are available to other apps.
-        self.chkr = SpellChecker("en_US")
+        self.checkers = self.checkerPool()
         # keep a local copy cached to minimize the number of
         # requests to linkedin and to provide "offline" access
         # to the most recently downloaded version.
         # remember to delete this file after you edit your
-        # linkedin profile
+        # linkedin profile. every download is also kept in the
+        # snapshot store so older versions can still be rendered
+        # by passing ProfileStore().asOf(...) in as the data.
+        if data is not None :
+            self.data = data
+            return
         try :
-            f = open(self.home + '/.jitresume', 'r');
-            profile = f.read();
+            profile = self.readCache()
         except IOError :
+            profile = self.fillCache()
+        self.data = cjson.decode(profile)
+
+    def readCache(self) :
+        f = open(self.home + '/.jitresume', 'r');
+        profile = f.read();
+        f.close()
+        return profile
+
+    # only the fetch is serialised (so a missing cache is downloaded
+    # once, not once per thread); reads never wait. the new copy is
+    # renamed into place so a reader never sees half of it.
+    def fillCache(self) :
+        with Resume.cacheLock :
+            try :
+                return self.readCache()
+            except IOError :
+                pass
             conn = LinkedIn()
             profile = conn.getProfile()
-            f = open(self.home + '/.jitresume', 'w');
+            path = self.home + '/.jitresume'
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            f = open(tmp, 'w');
             f.write(profile)
-        finally :
-            self.data = cjson.decode(profile)
             f.close()
+            os.rename(tmp, path)
+            ProfileStore().save(profile)
+            return profile
+
+    # the checker pool is created by the first resume so that its
+    # size can come from the config file
+    def checkerPool(self) :
+        with Resume.checkersLock :
+            if Resume.checkers is None :
+                Resume.checkers = CheckerPool("en_US",
+                    int(self.config.fetch('checkers_max')))
+            return Resume.checkers
+
+    # each warning is a single write so lines from different threads
+    # don't run together
+    def spellCheck(self, text) :
+        for word in self.checkers.check(text) :
+            sys.stdout.write('spell warning: %s\n' % word)
     
     # essentially, all the "content" methods are convenience wrappers
     # that return 1 or more (tuples) strings of content from the data
@@ -159,9 +575,7 @@ class Resume(App) :
     # returns the text of a the professional summary
     def summary(self) :
         tmp = self.data['summary']
-        self.chkr.set_text(tmp)
-        for err in self.chkr :
-            print "spell warning:", err.word
+        self.spellCheck(tmp)
         return '\n'.join(textwrap.wrap(tmp, self.width))
 
     # generates a limited number of skills taken from the linkedin data
@@ -182,9 +596,7 @@ class Resume(App) :
         while count < num :
             tmp = self.data['positions']['values'][count]
             summary = tmp['summary']
-            self.chkr.set_text(summary)
-            for err in self.chkr :
-                print "spell warning:", err.word
+            self.spellCheck(summary)
             summary = '\n'.join(textwrap.wrap(summary, self.width))
             endDate = 'Present'
             if tmp.has_key('endDate') :
@@ -262,9 +674,7 @@ class Resume(App) :
 
     def interests(self) :
         interests = self.data['interests']
-        self.chkr.set_text(interests)
-        for err in self.chkr :
-            print "spell warning:", err.word
+        self.spellCheck(interests)
         return '\n'.join(textwrap.wrap(interests, self.width))
 
     def content(self) :
@@ -273,8 +683,8 @@ class Resume(App) :
 # TextResume formats the resume in a Text format with some word
 # wrapping and someminimal layout
 class TextResume(Resume) :
-    def __init__(self) :
-        Resume.__init__(self)
+    def __init__(self, data=None) :
+        Resume.__init__(self, data)
 
     def header(self) :
         width = str(self.width)
@@ -343,8 +753,8 @@ class TextResume(Resume) :
                           self.interests()])
 
 class HTMLResume(Resume) :
-    def __init__(self) :
-        Resume.__init__(self)
+    def __init__(self, data=None) :
+        Resume.__init__(self, data)
         self.sectmpl = '\t<div class="section">\n\t    ' +\
                        '<span class="shdr">{}</span><hr/>\n{}\n\t</div>'
 
@@ -484,10 +894,17 @@ class HTMLResume(Resume) :
 
 # OpenDocument Formatter for the Resume content
 class ODFResume(Resume) :
-    def __init__(self, filename) :
-        Resume.__init__(self)
+    def __init__(self, filename, data=None) :
+        Resume.__init__(self, data)
         self.filename = filename
-        self.doc = OpenDocumentText()
+        self.local = threading.local()
+
+    # the document being built belongs to the render in progress, not
+    # to the resume, so one resume can be rendered by several threads
+    # at once (and more than once) without the documents mixing
+    @property
+    def doc(self) :
+        return self.local.doc
     
     # create a bunch of styles for the different sections. These should
     # be able to be paired down to something more reasonable. At this
@@ -679,23 +1096,68 @@ class ODFResume(Resume) :
         t.addElement(P(text='INTERESTS', stylename="Heading"))
         t.addElement(P(text=Resume.interests(self), stylename="Body"))
 
-    def content(self) :
-        self.pre()
-        self.header()
-        self.summary()
-        self.skills()
-        self.experience()
-        self.education()
-        self.certifications()
-        self.languages()
-        self.interests()
-        self.post()
-        self.doc.save(self.filename)
+    # builds and returns a new document
+    def render(self) :
+        self.local.doc = OpenDocumentText()
+        try :
+            self.pre()
+            self.header()
+            self.summary()
+            self.skills()
+            self.experience()
+            self.education()
+            self.certifications()
+            self.languages()
+            self.interests()
+            self.post()
+            return self.doc
+        finally :
+            del self.local.doc
+
+    def content(self, filename=None) :
+        if filename is None :
+            filename = self.filename
+        self.render().save(filename)
+
+# renders every profile with every formatter, first one at a time
+# (twice) and then all at once on a pool of threads, and raises an
+# Error if the two serial renders or any threaded result differ from
+# the first serial one. each resume is built
+# once and rendered threads times per round, so the same instance is
+# being rendered by several threads at the same time. rounds repeats
+# the threaded pass to give races more of a chance to show up.
+def stress(profiles, threads=8, rounds=10) :
+    def render(resume) :
+        if isinstance(resume, ODFResume) :
+            doc = resume.render()
+            return doc.contentxml() + doc.stylesxml()
+        return resume.content()
+    resumes = []
+    for data in profiles :
+        resumes += [TextResume(data), HTMLResume(data),
+                    ODFResume(None, data)]
+    expected = dict((id(r), render(r)) for r in resumes)
+    for resume in resumes :
+        if render(resume) != expected[id(resume)] :
+            raise Error('repeated serial renders differ')
+    jobs = resumes * threads
+    pool = ThreadPool(threads)
+    try :
+        for count in range(rounds) :
+            random.shuffle(jobs)
+            for resume, result in zip(jobs, pool.map(render, jobs)) :
+                if result != expected[id(resume)] :
+                    raise Error('threaded render differs from serial render')
+    finally :
+        pool.close()
+        pool.join()
+    return len(jobs) * rounds
 
 def main() :
     ODFResume('myresume.odt').content()
 #     print HTMLResume().content()
 #     print TextResume().content()
+#     print stress([ProfileStore().asOf()]), 'concurrent renders ok'
     
 
 if __name__ == '__main__' :
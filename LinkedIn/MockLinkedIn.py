@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+#
+#    Filename: MockLinkedIn.py
+#
+#    Description:
+#        A local stand in for the LinkedIn profile API used by
+#        JITProfile.py and a load generator to run against it. The
+#        server answers /v1/people/~:(...) with made up profiles after
+#        checking the OAuth signature the same way LinkedIn would, and
+#        can be told to be slow, to fail, or to throttle. The load
+#        generator hammers LinkedIn.getProfile (or the ~/.jitresume
+#        cache fill in Resume) from a pool of threads and reports
+#        latency percentiles and throughput.
+#
+#        python MockLinkedIn.py serve --port 8080 --latency 0.2
+#        python MockLinkedIn.py load --threads 16 --requests 2000
+#
+#  ====================================================================
+
+import oauth2
+import cjson
+import re
+import math
+import os
+import time
+import random
+import hashlib
+import shutil
+import tempfile
+import argparse
+import threading
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
+
+import JITProfile
+
+# splits the field selector on the commas that aren't inside
+# parentheses, returning the top level field names in the camel case
+# used by the json response (certifications:(name) -> certifications)
+def fieldNames(selector) :
+    names = []
+    depth = 0
+    name = ''
+    for c in selector + ',' :
+        if c == '(' :
+            depth += 1
+        elif c == ')' :
+            depth -= 1
+        elif c == ',' and depth == 0 :
+            name = name.split(':')[0]
+            names.append(re.sub('-(.)', lambda m: m.group(1).upper(), name))
+            name = ''
+        elif depth == 0 :
+            name += c
+    return names
+
+# a random number generator for one part of one made up person, so
+# each part comes out the same however many of the others are drawn
+def generator(seed, *part) :
+    key = ' '.join(str(p) for p in (seed,) + part)
+    return random.Random(int(hashlib.md5(key).hexdigest(), 16))
+
+words = ['design', 'systems', 'scalable', 'team', 'delivered',
+         'managed', 'software', 'customers', 'platform', 'data',
+         'performance', 'built', 'led', 'services', 'reliable']
+
+def text(r, n) :
+    return ' '.join(r.choice(words) for i in range(n)).capitalize() + '.'
+
+# builds a made up profile in the same shape as the linkedin response.
+# the same seed always gives the same person, and each version moves
+# them along a little the way a real profile changes between
+# refreshes: one more recommendation every version, a new skill every
+# third and a new job every tenth. everything else stays the same.
+def syntheticProfile(seed, version=0) :
+    r = generator(seed, 'name')
+    first = r.choice(['Ann', 'Bob', 'Chen', 'Dana', 'Eli', 'Fay'])
+    last = r.choice(['Smith', 'Jones', 'Garcia', 'Kim', 'Patel'])
+    r = generator(seed, 'positions')
+    year = 1990 + r.randint(0, 10)
+    positions = []
+    for i in range(r.randint(2, 6) + version / 10) :
+        r = generator(seed, 'position', i)
+        if positions :
+            positions[0]['endDate'] = {'year': year}
+        positions.insert(0, {
+            'company': {'name': 'Company %d' % r.randint(1, 999)},
+            'title': text(r, 3)[:-1], 'summary': text(r, r.randint(20, 60)),
+            'startDate': {'year': year}})
+        year += r.randint(1, 4)
+    start = positions[-1]['startDate']['year']
+    skills = []
+    for i in range(generator(seed, 'skills').randint(5, 30) + version / 3) :
+        r = generator(seed, 'skill', i)
+        skills.append({'skill': {'name': 'Skill %d' % r.randint(1, 500)}})
+    def collection(values) :
+        return {'_total': len(values), 'values': values}
+    return {
+        'firstName': first, 'lastName': last,
+        'industry': 'Computer Software',
+        'headline': text(generator(seed, 'headline'), 5)[:-1],
+        'mainAddress': '%d Main St\nSpringfield, CA 9%04d' %
+                       (generator(seed, 'address').randint(1, 999),
+                        seed % 10000),
+        'emailAddress': '%s.%s%d@example.com' % (first, last, seed),
+        'memberUrlResources': collection(
+            [{'url': 'https://example.com/%d' % seed}]),
+        'phoneNumbers': collection(
+            [{'phoneNumber': '555-%04d' % (seed % 10000)}]),
+        'location': {'name': 'San Francisco Bay Area'},
+        'numRecommenders':
+            generator(seed, 'recommenders').randint(0, 20) + version,
+        'currentStatus': text(generator(seed, 'status'), 4),
+        'summary': text(generator(seed, 'summary'),
+                        generator(seed, 'summary', 'length').randint(40, 120)),
+        'skills': collection(skills),
+        'positions': collection(positions),
+        'educations': collection([{'schoolName': 'State University',
+                                   'degree': "Bachelor's degree",
+                                   'fieldOfStudy': 'Computer Science',
+                                   'startDate': {'year': start - 4},
+                                   'endDate': {'year': start}}]),
+        'certifications': collection([{
+            'name': text(generator(seed, 'certification'), 2)[:-1],
+            'authority': {'name': 'Vendor'},
+            'startDate': {'year': start + 3}}]),
+        'interests': text(generator(seed, 'interests'), generator(
+                          seed, 'interests', 'length').randint(10, 30)),
+        'languages': collection([{'language': {'name': 'English'},
+                                  'proficiency': {'name': 'Native'}}])}
+
+# the behaviour of the mock server, shared by all request threads.
+# latency is a base delay plus up to jitter more, error_rate and
+# throttle_rate are the chance of a 500 or a throttle response, and
+# limit caps the calls per second (0 for no cap) with throttle
+# responses once it is reached.
+class Settings :
+    def __init__(self, api_key, secret_key, user_token, user_secret,
+                 latency=0.0, jitter=0.0, error_rate=0.0,
+                 throttle_rate=0.0, limit=0, profiles=1000) :
+        self.consumer = oauth2.Consumer(api_key, secret_key)
+        self.token = oauth2.Token(key=user_token, secret=user_secret)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.limit = limit
+        self.profiles = profiles
+        self.lock = threading.Lock()
+        self.second = 0
+        self.calls = 0
+        self.served = 0
+
+    # counts a call against the per second limit and returns False
+    # if it is over
+    def allow(self) :
+        with self.lock :
+            now = int(time.time())
+            if now != self.second :
+                self.second = now
+                self.calls = 0
+            self.calls += 1
+            return not self.limit or self.calls <= self.limit
+
+    # which profile (and which version of it) to serve next. only
+    # successful responses are counted, and each one gets its own
+    # number, so the versions of a profile come out in order
+    def nextProfile(self) :
+        with self.lock :
+            n = self.served
+            self.served += 1
+        return syntheticProfile(n % self.profiles, n / self.profiles)
+
+class Handler(BaseHTTPRequestHandler) :
+    path_re = re.compile(r'^/v1/people/~:\((.*)\)$')
+
+    # keep the per request log lines out of the load test output
+    def log_message(self, format, *args) :
+        pass
+
+    # linkedin errors come back as a small json document
+    def error(self, status, message) :
+        self.reply(status, {'errorCode': 0, 'message': message,
+                            'requestId': '%08X' % random.getrandbits(32),
+                            'status': status,
+                            'timestamp': int(time.time() * 1000)})
+
+    def reply(self, status, body) :
+        body = cjson.encode(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # rebuilds the request as oauth2 sees it and checks the signature
+    # against the keys the server was started with
+    def verify(self, path, query) :
+        settings = self.server.settings
+        url = 'http://' + self.headers.get('Host', '') + path
+        req = oauth2.Request.from_request('GET', url,
+                                          headers=dict(self.headers),
+                                          query_string=query)
+        if req is None :
+            return 'missing oauth parameters'
+        server = oauth2.Server()
+        server.add_signature_method(oauth2.SignatureMethod_HMAC_SHA1())
+        try :
+            server.verify_request(req, settings.consumer, settings.token)
+        except oauth2.Error, e :
+            return str(e)
+        return None
+
+    def do_GET(self) :
+        settings = self.server.settings
+        path, query = (self.path.split('?', 1) + [''])[:2]
+        m = self.path_re.match(path)
+        if not m :
+            return self.error(404, 'Unknown resource ' + path)
+        problem = self.verify(path, query)
+        if problem :
+            return self.error(401, '[unauthorized]. ' + problem)
+        time.sleep(settings.latency + random.random() * settings.jitter)
+        if not settings.allow() or random.random() < settings.throttle_rate :
+            return self.error(403, 'Throttle limit for calls to this ' +
+                                   'resource is reached.')
+        if random.random() < settings.error_rate :
+            return self.error(500, 'Internal API server error')
+        profile = settings.nextProfile()
+        fields = fieldNames(m.group(1))
+        self.reply(200, dict((k, v) for k, v in profile.items()
+                             if k in fields))
+
+class MockServer(ThreadingMixIn, HTTPServer) :
+    daemon_threads = True
+
+    def __init__(self, settings, port=0) :
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.settings = settings
+
+    def url(self) :
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    # serve from a background thread (used by the load generator)
+    def start(self) :
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+# nearest rank percentile of an already sorted list
+def percentile(values, p) :
+    if not values :
+        return 0.0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+# drives the fetch path against url from a pool of threads. the
+# keys and the cache live in a throw away home directory so the real
+# ~/.jitconfig and ~/.jitresume are never touched. in 'fetch' mode
+# every request is a LinkedIn.getProfile call, in 'cache' mode it is
+# a Resume whose ~/.jitresume has been removed first with a chance of
+# refresh (so the rest are cache hits).
+class LoadGenerator :
+    def __init__(self, url, keys, threads=8, mode='fetch', refresh=0.1) :
+        self.threads = threads
+        self.mode = mode
+        self.refresh = refresh
+        self.home = tempfile.mkdtemp(prefix='jitload')
+        f = open(os.path.join(self.home, '.jitconfig'), 'w')
+        for k, v in zip(('api_key', 'secret_key', 'user_token',
+                         'user_secret'), keys) + [('api_url', url)] :
+            f.write('%s %s\n' % (k, v))
+        f.close()
+        self.oldHome = os.environ.get('HOME')
+        os.environ['HOME'] = self.home
+
+    def close(self) :
+        if self.oldHome is None :
+            del os.environ['HOME']
+        else :
+            os.environ['HOME'] = self.oldHome
+        shutil.rmtree(self.home, True)
+
+    # returns (seconds, outcome) where outcome is 'ok', the http status
+    # of a failed call, or the name of any other exception
+    def one(self, count) :
+        start = time.time()
+        try :
+            if self.mode == 'cache' :
+                if random.random() < self.refresh :
+                    try :
+                        os.remove(os.path.join(self.home, '.jitresume'))
+                    except OSError :
+                        pass
+                JITProfile.Resume()
+            else :
+                JITProfile.LinkedIn().getProfile()
+            outcome = 'ok'
+        except JITProfile.Error, e :
+            outcome = e.args[0]
+        except Exception, e :
+            outcome = type(e).__name__
+        return (time.time() - start, outcome)
+
+    def run(self, requests) :
+        pool = ThreadPool(self.threads)
+        start = time.time()
+        try :
+            results = pool.map(self.one, range(requests))
+        finally :
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+        return Report(results, elapsed)
+
+class Report :
+    def __init__(self, results, elapsed) :
+        self.elapsed = elapsed
+        self.latencies = sorted(t for t, outcome in results
+                                if outcome == 'ok')
+        self.outcomes = {}
+        for t, outcome in results :
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        self.total = len(results)
+
+    def __str__(self) :
+        ms = lambda p: percentile(self.latencies, p) * 1000
+        lines = ['requests   %d in %.2fs (%.1f/s, %.1f ok/s)' %
+                 (self.total, self.elapsed, self.total / self.elapsed,
+                  len(self.latencies) / self.elapsed)]
+        if self.latencies :
+            lines.append('latency    p50 %.1fms  p90 %.1fms  p99 %.1fms  '
+                         'max %.1fms' % (ms(50), ms(90), ms(99), ms(100)))
+        for outcome, count in sorted(self.outcomes.items()) :
+            lines.append('%-10s %d' % (outcome, count))
+        return '\n'.join(lines)
+
+def main() :
+    parser = argparse.ArgumentParser(description='mock LinkedIn API')
+    parser.add_argument('command', choices=['serve', 'load'])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--keys', nargs=4, default=['key', 'secret',
+                        'token', 'tokensecret'], metavar='KEY',
+                        help='api_key secret_key user_token user_secret')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--limit', type=int, default=0,
+                        help='calls per second before throttling')
+    parser.add_argument('--profiles', type=int, default=1000)
+    parser.add_argument('--url', help='load an already running server')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--mode', choices=['fetch', 'cache'],
+                        default='fetch')
+    parser.add_argument('--refresh', type=float, default=0.1)
+    args = parser.parse_args()
+    settings = Settings(*args.keys, latency=args.latency,
+                        jitter=args.jitter, error_rate=args.error_rate,
+                        throttle_rate=args.throttle_rate,
+                        limit=args.limit, profiles=args.profiles)
+    if args.command == 'serve' :
+        server = MockServer(settings, args.port)
+        print 'serving on', server.url()
+        server.serve_forever()
+        return
+    url = args.url
+    if url is None :
+        url = MockServer(settings).start().url()
+    load = LoadGenerator(url, args.keys, args.threads, args.mode,
+                         args.refresh)
+    try :
+        print load.run(args.requests)
+    finally :
+        load.close()
+
+if __name__ == '__main__' :
+    main()